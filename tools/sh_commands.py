@@ -12,20 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import contextlib
+import errno
 import falcon_cli
 import filelock
+import functools
 import glob
+import hashlib
 import logging
-import numpy as np
+import mmap
 import os
 import re
 import sh
+import shutil
 import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
-import urllib
+import urllib2
+from distutils.spawn import find_executable
 from enum import Enum
+from multiprocessing.pool import ThreadPool
 
 import common
 
@@ -45,8 +56,90 @@ except Exception as e:
 ################################
 
 
+def memoize(func):
+    cache = {}
+    cache_lock = threading.Lock()
+
+    @functools.wraps(func)
+    def memoized_func(*args):
+        with cache_lock:
+            if args in cache:
+                return cache[args]
+        result = func(*args)
+        # empty results usually mean a failed lookup, retry them next time
+        if result:
+            with cache_lock:
+                cache[args] = result
+        return result
+
+    memoized_func.cache_clear = cache.clear
+    return memoized_func
+
+
+@memoize
+def sh_command(name):
+    # resolve each command once instead of on every sh.<name> lookup
+    return sh.Command(name)
+
+
+def _parallel_map(func, items, max_workers=32):
+    # adb calls spend their time waiting on the device, so threads suffice
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    # ThreadPool workers only forward Exception, so SystemExit raised by
+    # MaceLogger.error would hang map(); carry it back to the caller
+    def call(item):
+        try:
+            return True, func(item)
+        except BaseException:
+            return False, sys.exc_info()
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        results = pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+    for succeeded, result in results:
+        if not succeeded:
+            raise result[0], result[1], result[2]
+    return [result for _, result in results]
+
+
+def _makedirs(path):
+    # same as `mkdir -p`
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _remove_path(path):
+    # same as `rm -rf`
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _remove_file(path):
+    # same as `rm -f`
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
 def strip_invalid_utf8(str):
-    return sh.iconv(str, "-c", "-t", "UTF-8")
+    if isinstance(str, sh.RunningCommand):
+        str = str.stdout
+    if isinstance(str, unicode):
+        return str
+    return str.decode("utf-8", "ignore").encode("utf-8")
 
 
 def split_stdout(stdout_str):
@@ -55,10 +148,20 @@ def split_stdout(stdout_str):
     return [l.strip() for l in stdout_str.split('\n') if len(l.strip()) > 0]
 
 
-def make_output_processor(buff):
+def make_output_processor(sink):
+    # sink is a list collecting the lines or a binary file object to stream
+    # them to, sh hands the lines over as unicode
+    if hasattr(sink, "write"):
+        def write_line(line):
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+            sink.write(line)
+    else:
+        write_line = sink.append
+
     def process_output(line):
         print(line.rstrip())
-        buff.append(line)
+        write_line(line)
 
     return process_output
 
@@ -84,23 +187,18 @@ class BuildType(object):
     code = 'code'
 
 
+_FAIL_RE = re.compile(r'Aborted|FAILED|Segmentation fault')
+
+
 def stdout_success(stdout):
-    stdout_lines = stdout.split("\n")
-    for line in stdout_lines:
-        if "Aborted" in line or "FAILED" in line or \
-                        "Segmentation fault" in line:
-            return False
-    return True
+    return _FAIL_RE.search(stdout) is None
 
 
 ################################
 # clear data
 ################################
 def clear_phone_data_dir(serialno, phone_data_dir):
-    sh.adb("-s",
-           serialno,
-           "shell",
-           "rm -rf %s" % phone_data_dir)
+    adb_call(serialno, "shell", "rm -rf %s" % phone_data_dir)
 
 
 def clear_model_codegen(model_codegen_dir="mace/codegen/models"):
@@ -111,22 +209,127 @@ def clear_model_codegen(model_codegen_dir="mace/codegen/models"):
 ################################
 # adb commands
 ################################
+# Frequent adb calls go through subprocess directly, sh adds overhead
+_ADB = find_executable("adb") or "adb"
+
+
+def adb_call(serialno, *args):
+    return subprocess.check_output([_ADB, "-s", serialno] + list(args))
+
+
+def adb_shell(serialno, *args):
+    # output goes straight to the console, like sh's _fg=True
+    subprocess.check_call([_ADB, "-s", serialno, "shell"] + list(args))
+
+
+# One long-lived `adb shell` per device, commands are fed to its stdin
+# and the output is read back until the end marker is echoed.
+_SHELL_END_MARKER = "__MACE_SHELL_END__"
+_SHELL_END_RE = re.compile(r'%s (\d+)$' % _SHELL_END_MARKER)
+_shell_pool = {}
+_shell_pool_lock = threading.Lock()
+_DEVICES_RE = re.compile(r'(\w+)\s+device')
+_PROP_RE = re.compile(r'\[(.+)\]: \[(.+)\]')
+
+
+def _persistent_shell(serialno):
+    with _shell_pool_lock:
+        if serialno in _shell_pool and \
+                _shell_pool[serialno][0].poll() is None:
+            return _shell_pool[serialno]
+        shell = subprocess.Popen([_ADB, "-s", serialno, "shell"],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+        _shell_pool[serialno] = (shell, threading.Lock())
+        return _shell_pool[serialno]
+
+
+def _drop_persistent_shell(serialno, shell):
+    with _shell_pool_lock:
+        if serialno in _shell_pool and _shell_pool[serialno][0] is shell:
+            del _shell_pool[serialno]
+    if shell.poll() is None:
+        shell.kill()
+    shell.wait()
+
+
+def persistent_shell_run(serialno, command):
+    # raises subprocess.CalledProcessError like adb_call if the command
+    # fails or the shell dies before echoing the end marker
+    shell, shell_lock = _persistent_shell(serialno)
+    cmd = [_ADB, "-s", serialno, "shell", command]
+    with shell_lock:
+        lines = []
+        try:
+            shell.stdin.write("%s; echo %s $?\n" %
+                              (command, _SHELL_END_MARKER))
+            shell.stdin.flush()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        else:
+            for line in iter(shell.stdout.readline, ""):
+                m = _SHELL_END_RE.search(line.rstrip())
+                if m:
+                    lines.append(line[:m.start()])
+                    output = "".join(lines)
+                    returncode = int(m.group(1))
+                    if returncode != 0:
+                        raise subprocess.CalledProcessError(
+                            returncode, cmd, output)
+                    return output
+                lines.append(line)
+        _drop_persistent_shell(serialno, shell)
+        raise subprocess.CalledProcessError(shell.returncode or 1, cmd,
+                                            "".join(lines))
+
+
+def _close_persistent_shell(shell, timeout=1):
+    # PTY mode adb shell of older devices does not forward stdin EOF,
+    # so ask the shell to exit and kill it if it does not in time
+    if shell.poll() is None:
+        try:
+            shell.stdin.write("exit\n")
+            shell.stdin.close()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        deadline = time.time() + timeout
+        while shell.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if shell.poll() is None:
+            shell.kill()
+    shell.wait()
+
+
+@atexit.register
+def close_persistent_shells():
+    with _shell_pool_lock:
+        for shell, _ in _shell_pool.values():
+            _close_persistent_shell(shell)
+        _shell_pool.clear()
+
+
 def adb_devices():
     serialnos = []
-    p = re.compile(r'(\w+)\s+device')
-    for line in split_stdout(sh.adb("devices")):
-        m = p.match(line)
+    for line in split_stdout(subprocess.check_output([_ADB, "devices"])):
+        m = _DEVICES_RE.match(line)
         if m:
             serialnos.append(m.group(1))
 
     return serialnos
 
 
-def get_soc_serialnos_map():
+@memoize
+def _enumerate_devices():
     serialnos = adb_devices()
+    return zip(serialnos,
+               _parallel_map(adb_getprop_by_serialno, serialnos))
+
+
+def get_soc_serialnos_map():
     soc_serialnos_map = {}
-    for serialno in serialnos:
-        props = adb_getprop_by_serialno(serialno)
+    for serialno, props in _enumerate_devices():
         soc_serialnos_map.setdefault(props["ro.board.platform"], [])\
             .append(serialno)
 
@@ -144,10 +347,8 @@ def get_target_socs_serialnos(target_socs=None):
 
 
 def get_soc_serial_number_map():
-    serial_numbers = adb_devices()
     soc_serial_number_map = {}
-    for num in serial_numbers:
-        props = adb_getprop_by_serialno(num)
+    for num, props in _enumerate_devices():
         soc_serial_number_map[props["ro.board.platform"]] = num
     return soc_serial_number_map
 
@@ -160,18 +361,28 @@ def get_target_soc_serial_number(target_soc):
     return serial_number
 
 
+@memoize
 def adb_getprop_by_serialno(serialno):
-    outputs = sh.adb("-s", serialno, "shell", "getprop")
+    # device properties are static until reboot, query them once per process
+    outputs = persistent_shell_run(serialno, "getprop")
     raw_props = split_stdout(outputs)
     props = {}
-    p = re.compile(r'\[(.+)\]: \[(.+)\]')
     for raw_prop in raw_props:
-        m = p.match(raw_prop)
+        m = _PROP_RE.match(raw_prop)
         if m:
             props[m.group(1)] = m.group(2)
     return props
 
 
+def clear_device_cache():
+    # call after devices are reconnected or rebooted
+    _enumerate_devices.cache_clear()
+    adb_getprop_by_serialno.cache_clear()
+    adb_get_device_name_by_serialno.cache_clear()
+    close_persistent_shells()
+
+
+@memoize
 def adb_get_device_name_by_serialno(serialno):
     props = adb_getprop_by_serialno(serialno)
     return props.get("ro.product.model", "").replace(' ', '')
@@ -185,24 +396,46 @@ def adb_supported_abis(serialno):
 
 
 def adb_get_all_socs():
-    socs = []
-    for d in adb_devices():
-        props = adb_getprop_by_serialno(d)
-        socs.append(props["ro.board.platform"])
-    return set(socs)
+    return set(props["ro.board.platform"]
+               for _, props in _enumerate_devices())
 
 
 def adb_push(src_path, dst_path, serialno):
     print("Push %s to %s" % (src_path, dst_path))
-    sh.adb("-s", serialno, "push", src_path, dst_path)
+    adb_call(serialno, "push", src_path, dst_path)
+
+
+def adb_push_files(src_paths, dst_dir, serialno, staging_root=None,
+                   file_contents=None):
+    # stage all files in one host dir and push them in a single round trip.
+    # staging_root should be on the sources' filesystem so they are hard
+    # linked rather than copied, file_contents maps the names of generated
+    # files to their content, they are written straight into the stage
+    staging_dir = tempfile.mkdtemp(prefix="mace-push-", dir=staging_root)
+    try:
+        for src_path in src_paths:
+            staging_path = os.path.join(staging_dir,
+                                        os.path.basename(src_path))
+            try:
+                os.link(os.path.realpath(src_path), staging_path)
+            except OSError:
+                shutil.copy(src_path, staging_path)
+        for file_name, content in (file_contents or {}).iteritems():
+            with open(os.path.join(staging_dir, file_name), "w") as f:
+                f.write(content)
+        adb_push(staging_dir + "/.", dst_dir, serialno)
+    finally:
+        shutil.rmtree(staging_dir)
 
 
 def adb_pull(src_path, dst_path, serialno):
     print("Pull %s to %s" % (src_path, dst_path))
-    try:
-        sh.adb("-s", serialno, "pull", src_path, dst_path)
-    except Exception as e:
-        print("Error msg: %s" % e.stderr)
+    p = subprocess.Popen([_ADB, "-s", serialno, "pull", src_path, dst_path],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    _, err = p.communicate()
+    if p.returncode != 0:
+        print("Error msg: %s" % err)
 
 
 def adb_run(abi,
@@ -217,17 +450,17 @@ def adb_run(abi,
             address_sanitizer=False):
     host_bin_full_path = "%s/%s" % (host_bin_path, bin_name)
     device_bin_full_path = "%s/%s" % (device_bin_path, bin_name)
-    props = adb_getprop_by_serialno(serialno)
     print(
         "====================================================================="
     )
     print("Trying to lock device %s" % serialno)
     with device_lock(serialno):
+        props = adb_getprop_by_serialno(serialno)
         print("Run on device: %s, %s, %s" %
               (serialno, props["ro.board.platform"],
                props["ro.product.model"]))
-        sh.adb("-s", serialno, "shell", "rm -rf %s" % device_bin_path)
-        sh.adb("-s", serialno, "shell", "mkdir -p %s" % device_bin_path)
+        adb_call(serialno, "shell", "rm -rf %s && mkdir -p %s" %
+                 (device_bin_path, device_bin_path))
         adb_push(host_bin_full_path, device_bin_full_path, serialno)
         ld_preload = ""
         if address_sanitizer:
@@ -240,7 +473,7 @@ def adb_run(abi,
 
         stdout_buff = []
         process_output = make_output_processor(stdout_buff)
-        sh.adb(
+        sh_command("adb")(
             "-s",
             serialno,
             "shell",
@@ -267,11 +500,14 @@ def asan_rt_library_names(abi):
     return asan_rt_names[abi]
 
 
+@memoize
 def find_asan_rt_library(abi, asan_rt_path=''):
     if not asan_rt_path:
         find_path = os.environ['ANDROID_NDK_HOME']
-        candidates = split_stdout(sh.find(find_path, "-name",
-                                          asan_rt_library_names(abi)))
+        library_name = asan_rt_library_names(abi)
+        candidates = [os.path.join(root, library_name)
+                      for root, _, files in os.walk(find_path)
+                      if library_name in files]
         if len(candidates) == 0:
             common.MaceLogger.error(
                 "Toolchain",
@@ -293,18 +529,17 @@ def bazel_build(target,
                 enable_openmp=True,
                 enable_neon=True,
                 address_sanitizer=False):
-    print("* Build %s with ABI %s" % (target, abi))
+    # several targets share one bazel invocation and analysis phase
+    targets = list(target) if isinstance(target, (list, tuple)) else [target]
+    print("* Build %s with ABI %s" % (" ".join(targets), abi))
     if abi == "host":
         bazel_args = (
             "build",
             "--define",
             "openmp=%s" % str(enable_openmp).lower(),
-            target,
-        )
+        ) + tuple(targets)
     else:
-        bazel_args = (
-            "build",
-            target,
+        bazel_args = ("build",) + tuple(targets) + (
             "--config",
             "android",
             "--cpu=%s" % abi,
@@ -318,7 +553,7 @@ def bazel_build(target,
         bazel_args += ("--config", "asan")
     else:
         bazel_args += ("--config", "optimization")
-    sh.bazel(
+    sh_command("bazel")(
         _fg=True,
         *bazel_args)
     print("Build done!\n")
@@ -327,7 +562,7 @@ def bazel_build(target,
 def bazel_build_common(target, build_args=""):
     stdout_buff = []
     process_output = make_output_processor(stdout_buff)
-    sh.bazel(
+    sh_command("bazel")(
         "build",
         target + build_args,
         _tty_in=True,
@@ -350,7 +585,7 @@ def bazel_target_to_bin(target):
 # mace commands
 ################################
 def gen_encrypted_opencl_source(codegen_path="mace/codegen"):
-    sh.mkdir("-p", "%s/opencl" % codegen_path)
+    _makedirs("%s/opencl" % codegen_path)
     encrypt_opencl_codegen("./mace/kernels/opencl/cl/",
                            "mace/codegen/opencl/opencl_encrypt_program.cc")
 
@@ -360,8 +595,8 @@ def gen_mace_engine_factory_source(model_tags,
                                    codegen_path="mace/codegen"):
     print("* Genearte mace engine creator source")
     codegen_tools_dir = "%s/engine" % codegen_path
-    sh.rm("-rf", codegen_tools_dir)
-    sh.mkdir("-p", codegen_tools_dir)
+    _remove_path(codegen_tools_dir)
+    _makedirs(codegen_tools_dir)
     gen_mace_engine_factory(
         model_tags,
         "mace/python/tools",
@@ -370,14 +605,16 @@ def gen_mace_engine_factory_source(model_tags,
     print("Genearte mace engine creator source done!\n")
 
 
+def opencl_bin_dirs(model_output_dirs):
+    return [os.path.join(d, "opencl_bin") for d in model_output_dirs]
+
+
 def pull_binaries(abi, serialno, model_output_dirs,
                   cl_built_kernel_file_name):
     compiled_opencl_dir = "/data/local/tmp/mace_run/interior/"
     mace_run_param_file = "mace_run.config"
 
-    cl_bin_dirs = []
-    for d in model_output_dirs:
-        cl_bin_dirs.append(os.path.join(d, "opencl_bin"))
+    cl_bin_dirs = opencl_bin_dirs(model_output_dirs)
     cl_bin_dirs_str = ",".join(cl_bin_dirs)
     if cl_bin_dirs:
         cl_bin_dir = cl_bin_dirs_str
@@ -395,9 +632,7 @@ def merge_opencl_binaries(binaries_dirs,
                           cl_compiled_program_file_name,
                           output_file_path):
     platform_info_key = 'mace_opencl_precompiled_platform_info_key'
-    cl_bin_dirs = []
-    for d in binaries_dirs:
-        cl_bin_dirs.append(os.path.join(d, "opencl_bin"))
+    cl_bin_dirs = opencl_bin_dirs(binaries_dirs)
     # create opencl binary output dir
     opencl_binary_dir = os.path.dirname(output_file_path)
     if not os.path.exists(opencl_binary_dir):
@@ -409,56 +644,60 @@ def merge_opencl_binaries(binaries_dirs,
             continue
 
         print 'generate opencl code from', binary_path
-        with open(binary_path, "rb") as f:
-            binary_array = np.fromfile(f, dtype=np.uint8)
-
-        idx = 0
-        size, = struct.unpack("Q", binary_array[idx:idx + 8])
-        idx += 8
-        for _ in xrange(size):
-            key_size, = struct.unpack("i", binary_array[idx:idx + 4])
-            idx += 4
-            key, = struct.unpack(
-                str(key_size) + "s", binary_array[idx:idx + key_size])
-            idx += key_size
-            value_size, = struct.unpack("i", binary_array[idx:idx + 4])
-            idx += 4
-            if key == platform_info_key and key in kvs:
-                common.mace_check(
-                    (kvs[key] == binary_array[idx:idx + value_size]).all(),
-                    "",
-                    "There exists more than one OpenCL version for models:"
-                    " %s vs %s " %
-                    (kvs[key], binary_array[idx:idx + value_size]))
-            else:
-                kvs[key] = binary_array[idx:idx + value_size]
-            idx += value_size
-
-    output_byte_array = bytearray()
+        with open(binary_path, "rb") as f, contextlib.closing(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
+            idx = 0
+            size, = struct.unpack_from("Q", mm, idx)
+            idx += 8
+            for _ in xrange(size):
+                key_size, = struct.unpack_from("i", mm, idx)
+                idx += 4
+                key = mm[idx:idx + key_size]
+                idx += key_size
+                value_size, = struct.unpack_from("i", mm, idx)
+                idx += 4
+                value = mm[idx:idx + value_size]
+                idx += value_size
+                if key == platform_info_key and key in kvs:
+                    common.mace_check(
+                        kvs[key] == value,
+                        "",
+                        "There exists more than one OpenCL version for"
+                        " models: %s vs %s " % (kvs[key], value))
+                else:
+                    kvs[key] = value
+
     data_size = len(kvs)
-    output_byte_array.extend(struct.pack("Q", data_size))
+    output_size = 8 + sum(4 + len(key) + 4 + len(value)
+                          for key, value in kvs.iteritems())
+    output_byte_array = bytearray(output_size)
+    output_view = memoryview(output_byte_array)
+    idx = 0
+    struct.pack_into("Q", output_byte_array, idx, data_size)
+    idx += 8
     for key, value in kvs.iteritems():
         key_size = len(key)
-        output_byte_array.extend(struct.pack("i", key_size))
-        output_byte_array.extend(struct.pack(str(key_size) + "s", key))
+        struct.pack_into("i", output_byte_array, idx, key_size)
+        idx += 4
+        output_view[idx:idx + key_size] = key
+        idx += key_size
         value_size = len(value)
-        output_byte_array.extend(struct.pack("i", value_size))
-        output_byte_array.extend(value)
+        struct.pack_into("i", output_byte_array, idx, value_size)
+        idx += 4
+        output_view[idx:idx + value_size] = value
+        idx += value_size
 
-    np.array(output_byte_array).tofile(output_file_path)
+    with open(output_file_path, "wb") as f:
+        f.write(output_byte_array)
 
 
 def gen_tuning_param_code(model_output_dirs,
                           codegen_path="mace/codegen"):
     mace_run_param_file = "mace_run.config"
-    cl_bin_dirs = []
-    for d in model_output_dirs:
-        cl_bin_dirs.append(os.path.join(d, "opencl_bin"))
-    cl_bin_dirs_str = ",".join(cl_bin_dirs)
+    cl_bin_dirs_str = ",".join(opencl_bin_dirs(model_output_dirs))
 
     tuning_codegen_dir = "%s/tuning/" % codegen_path
-    if not os.path.exists(tuning_codegen_dir):
-        sh.mkdir("-p", tuning_codegen_dir)
+    _makedirs(tuning_codegen_dir)
 
     tuning_param_variable_name = "kTuningParamsData"
     tuning_param_codegen(cl_bin_dirs_str,
@@ -493,32 +732,48 @@ def gen_model_code(model_codegen_dir,
                    transformers):
     bazel_build_common("//mace/python/tools:converter")
 
-    if os.path.exists(model_codegen_dir):
-        sh.rm("-rf", model_codegen_dir)
-    sh.mkdir("-p", model_codegen_dir)
-
-    sh.python("bazel-bin/mace/python/tools/converter",
-              "-u",
-              "--platform=%s" % platform,
-              "--model_file=%s" % model_file_path,
-              "--weight_file=%s" % weight_file_path,
-              "--model_checksum=%s" % model_sha256_checksum,
-              "--weight_checksum=%s" % weight_sha256_checksum,
-              "--input_node=%s" % input_nodes,
-              "--output_node=%s" % output_nodes,
-              "--runtime=%s" % runtime,
-              "--template=%s" % "mace/python/tools",
-              "--model_tag=%s" % model_tag,
-              "--input_shape=%s" % input_shapes,
-              "--dsp_mode=%s" % dsp_mode,
-              "--embed_model_data=%s" % embed_model_data,
-              "--winograd=%s" % winograd,
-              "--obfuscate=%s" % obfuscate,
-              "--output_dir=%s" % model_codegen_dir,
-              "--model_build_type=%s" % model_build_type,
-              "--data_type=%s" % data_type,
-              "--transformers=%s" % transformers,
-              _fg=True)
+    # generate into a fresh sibling dir and swap it in once it is complete
+    new_model_codegen_dir = "%s.new" % model_codegen_dir
+    _remove_path(new_model_codegen_dir)
+    _makedirs(new_model_codegen_dir)
+
+    try:
+        sh.python("bazel-bin/mace/python/tools/converter",
+                  "-u",
+                  "--platform=%s" % platform,
+                  "--model_file=%s" % model_file_path,
+                  "--weight_file=%s" % weight_file_path,
+                  "--model_checksum=%s" % model_sha256_checksum,
+                  "--weight_checksum=%s" % weight_sha256_checksum,
+                  "--input_node=%s" % input_nodes,
+                  "--output_node=%s" % output_nodes,
+                  "--runtime=%s" % runtime,
+                  "--template=%s" % "mace/python/tools",
+                  "--model_tag=%s" % model_tag,
+                  "--input_shape=%s" % input_shapes,
+                  "--dsp_mode=%s" % dsp_mode,
+                  "--embed_model_data=%s" % embed_model_data,
+                  "--winograd=%s" % winograd,
+                  "--obfuscate=%s" % obfuscate,
+                  "--output_dir=%s" % new_model_codegen_dir,
+                  "--model_build_type=%s" % model_build_type,
+                  "--data_type=%s" % data_type,
+                  "--transformers=%s" % transformers,
+                  _fg=True)
+    except Exception:
+        _remove_path(new_model_codegen_dir)
+        raise
+    _remove_path(model_codegen_dir)
+    os.rename(new_model_codegen_dir, model_codegen_dir)
+
+
+def download_file(url, dst_path):
+    response = urllib2.urlopen(url)
+    try:
+        with open(dst_path, "wb") as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+    finally:
+        response.close()
 
 
 def gen_random_input(model_output_dir,
@@ -554,6 +809,7 @@ def gen_random_input(model_output_dir,
         if len(input_file_list) != len(input_name_list):
             raise Exception('If input_files set, the input files should '
                             'match the input names.')
+        downloads = []
         for i in range(len(input_file_list)):
             if input_file_list[i] is not None:
                 dst_input_file = model_output_dir + '/' + \
@@ -561,9 +817,10 @@ def gen_random_input(model_output_dir,
                                                    input_name_list[i])
                 if input_file_list[i].startswith("http://") or \
                         input_file_list[i].startswith("https://"):
-                    urllib.urlretrieve(input_file_list[i], dst_input_file)
+                    downloads.append((input_file_list[i], dst_input_file))
                 else:
                     sh.cp("-f", input_file_list[i], dst_input_file)
+        _parallel_map(lambda download: download_file(*download), downloads)
 
 
 def update_mace_run_lib(build_tmp_binary_dir, linkshared=0):
@@ -572,14 +829,13 @@ def update_mace_run_lib(build_tmp_binary_dir, linkshared=0):
     else:
         mace_run_filepath = build_tmp_binary_dir + "/mace_run_shared"
 
-    if os.path.exists(mace_run_filepath):
-        sh.rm("-rf", mace_run_filepath)
+    _remove_path(mace_run_filepath)
     if linkshared == 0:
-        sh.cp("-f", "bazel-bin/mace/tools/validation/mace_run_static",
-              build_tmp_binary_dir)
+        shutil.copy2("bazel-bin/mace/tools/validation/mace_run_static",
+                     build_tmp_binary_dir)
     else:
-        sh.cp("-f", "bazel-bin/mace/tools/validation/mace_run_shared",
-              build_tmp_binary_dir)
+        shutil.copy2("bazel-bin/mace/tools/validation/mace_run_shared",
+                     build_tmp_binary_dir)
 
 
 def touch_tuned_file_flag(build_tmp_binary_dir):
@@ -592,7 +848,7 @@ def is_binary_tuned(build_tmp_binary_dir):
 
 def create_internal_storage_dir(serialno, phone_data_dir):
     internal_storage_dir = "%s/interior/" % phone_data_dir
-    sh.adb("-s", serialno, "shell", "mkdir", "-p", internal_storage_dir)
+    adb_call(serialno, "shell", "mkdir", "-p", internal_storage_dir)
     return internal_storage_dir
 
 
@@ -604,18 +860,16 @@ def update_libmace_shared_library(serial_num,
     library_dir = "%s/%s/%s/%s" % (
             build_output_dir, project_name, library_output_dir, abi)
 
-    if os.path.exists(library_dir):
-        sh.rm("-rf", library_dir)
-    sh.mkdir("-p", library_dir)
-    sh.cp("-f", "bazel-bin/mace/libmace.so", library_dir)
-    sh.cp("-f",
-          "%s/sources/cxx-stl/gnu-libstdc++/4.9/libs/%s/libgnustl_shared.so" %
-          (os.environ["ANDROID_NDK_HOME"], abi),
-          library_dir)
+    _remove_path(library_dir)
+    _makedirs(library_dir)
+    shutil.copy2("bazel-bin/mace/libmace.so", library_dir)
+    shutil.copy2(
+        "%s/sources/cxx-stl/gnu-libstdc++/4.9/libs/%s/libgnustl_shared.so" %
+        (os.environ["ANDROID_NDK_HOME"], abi),
+        library_dir)
 
-    if os.path.exists("mace/libmace.so"):
-        sh.rm("-f", "mace/libmace.so")
-    sh.cp("-f", "bazel-bin/mace/libmace.so", "mace/")
+    _remove_path("mace/libmace.so")
+    shutil.copy2("bazel-bin/mace/libmace.so", "mace/")
 
 
 def tuning_run(abi,
@@ -655,6 +909,10 @@ def tuning_run(abi,
           (model_tag, running_round, restart_round, str(tuning),
            str(out_of_range_check), omp_num_threads, cpu_affinity_policy,
            gpu_perf_hint, gpu_priority_hint))
+    input_nodes_str = ",".join(input_nodes)
+    output_nodes_str = ",".join(output_nodes)
+    input_shapes_str = ":".join(input_shapes)
+    output_shapes_str = ":".join(output_shapes)
     mace_model_path = ""
     if build_type == BuildType.proto:
         mace_model_path = "%s/%s.pb" % (mace_model_dir, model_tag)
@@ -670,10 +928,10 @@ def tuning_run(abi,
                 "MACE_RUNTIME_FAILURE_RATIO=%f" % runtime_failure_ratio,
                 "%s/%s" % (mace_run_dir, mace_run_target),
                 "--model_name=%s" % model_tag,
-                "--input_node=%s" % ",".join(input_nodes),
-                "--output_node=%s" % ",".join(output_nodes),
-                "--input_shape=%s" % ":".join(input_shapes),
-                "--output_shape=%s" % ":".join(output_shapes),
+                "--input_node=%s" % input_nodes_str,
+                "--output_node=%s" % output_nodes_str,
+                "--input_shape=%s" % input_shapes_str,
+                "--output_shape=%s" % output_shapes_str,
                 "--input_file=%s/%s" % (model_output_dir, input_file_name),
                 "--output_file=%s/%s" % (model_output_dir, output_file_name),
                 "--model_data_file=%s/%s.data" % (mace_model_dir, model_tag),
@@ -694,48 +952,38 @@ def tuning_run(abi,
         print("Running finished!\n")
         return stdout
     else:
-        sh.adb("-s", serialno, "shell", "mkdir", "-p", phone_data_dir)
+        # creating the internal storage dir creates phone_data_dir as well
         internal_storage_dir = create_internal_storage_dir(
             serialno, phone_data_dir)
 
+        push_files = []
         for input_name in input_nodes:
             formatted_name = common.formatted_file_name(input_file_name,
                                                         input_name)
-            adb_push("%s/%s" % (model_output_dir, formatted_name),
-                     phone_data_dir, serialno)
+            push_files.append("%s/%s" % (model_output_dir, formatted_name))
         if address_sanitizer:
-            adb_push(find_asan_rt_library(abi), phone_data_dir, serialno)
+            push_files.append(find_asan_rt_library(abi))
 
         if not embed_model_data:
-            adb_push("%s/%s.data" % (mace_model_dir, model_tag),
-                     phone_data_dir, serialno)
+            push_files.append("%s/%s.data" % (mace_model_dir, model_tag))
 
         if device_type == common.DeviceType.GPU\
                 and os.path.exists(opencl_binary_file):
-            adb_push(opencl_binary_file, phone_data_dir, serialno)
+            push_files.append(opencl_binary_file)
 
-        adb_push("third_party/nnlib/libhexagon_controller.so",
-                 phone_data_dir, serialno)
+        push_files.append("third_party/nnlib/libhexagon_controller.so")
 
         mace_model_phone_path = ""
         if build_type == BuildType.proto:
             mace_model_phone_path = "%s/%s.pb" % (phone_data_dir, model_tag)
-            adb_push(mace_model_path,
-                     mace_model_phone_path,
-                     serialno)
+            push_files.append(mace_model_path)
 
         if linkshared == 1:
-            adb_push("%s/libmace.so" % shared_library_dir, phone_data_dir,
-                     serialno)
-            adb_push("%s/libgnustl_shared.so" % shared_library_dir,
-                     phone_data_dir,
-                     serialno)
+            push_files.append("%s/libmace.so" % shared_library_dir)
+            push_files.append("%s/libgnustl_shared.so" % shared_library_dir)
 
-        adb_push("%s/%s" % (mace_run_dir, mace_run_target), phone_data_dir,
-                 serialno)
+        push_files.append("%s/%s" % (mace_run_dir, mace_run_target))
 
-        stdout_buff = []
-        process_output = make_output_processor(stdout_buff)
         adb_cmd = [
             "LD_LIBRARY_PATH=%s" % phone_data_dir,
             "MACE_TUNING=%s" % int(tuning),
@@ -754,10 +1002,10 @@ def tuning_run(abi,
         adb_cmd.extend([
             "%s/%s" % (phone_data_dir, mace_run_target),
             "--model_name=%s" % model_tag,
-            "--input_node=%s" % ",".join(input_nodes),
-            "--output_node=%s" % ",".join(output_nodes),
-            "--input_shape=%s" % ":".join(input_shapes),
-            "--output_shape=%s" % ":".join(output_shapes),
+            "--input_node=%s" % input_nodes_str,
+            "--output_node=%s" % output_nodes_str,
+            "--input_shape=%s" % input_shapes_str,
+            "--output_shape=%s" % output_shapes_str,
             "--input_file=%s/%s" % (phone_data_dir, input_file_name),
             "--output_file=%s/%s" % (phone_data_dir, output_file_name),
             "--model_data_file=%s/%s.data" % (phone_data_dir, model_tag),
@@ -775,38 +1023,143 @@ def tuning_run(abi,
         adb_cmd = ' '.join(adb_cmd)
         cmd_file_name = "%s-%s-%s" % ('cmd_file', model_tag, str(time.time()))
         adb_cmd_file = "%s/%s" % (phone_data_dir, cmd_file_name)
-        tmp_cmd_file = "%s/%s" % ('/tmp', cmd_file_name)
-        with open(tmp_cmd_file, 'w') as cmd_file:
-            cmd_file.write(adb_cmd)
-        adb_push(tmp_cmd_file, adb_cmd_file, serialno)
-        os.remove(tmp_cmd_file)
-
-        sh.adb(
-            "-s",
-            serialno,
-            "shell",
-            "sh",
-            adb_cmd_file,
-            _tty_in=True,
-            _out=process_output,
-            _err_to_out=True)
-        stdout = "".join(stdout_buff)
+        adb_push_files(push_files, phone_data_dir, serialno,
+                       staging_root=model_output_dir,
+                       file_contents={cmd_file_name: adb_cmd})
+
+        # spool the run log to disk while the device runs instead of growing
+        # a list of lines; callers parse the whole log, so it is still read
+        # back and returned as one string
+        with tempfile.TemporaryFile("w+b") as stdout_file:
+            sh_command("adb")(
+                "-s",
+                serialno,
+                "shell",
+                "sh",
+                adb_cmd_file,
+                _tty_in=True,
+                _out=make_output_processor(stdout_file),
+                _err_to_out=True)
+            stdout_file.seek(0)
+            stdout = stdout_file.read()
         if not stdout_success(stdout):
             common.MaceLogger.error("Mace Run", "Mace run failed.")
 
-        sh.adb(
-            "-s",
-            serialno,
-            "shell",
-            "rm",
-            adb_cmd_file,
-            _fg=True)
+        adb_shell(serialno, "rm", adb_cmd_file)
 
         print("Running finished!\n")
 
         return stdout
 
 
+def tuning_run_many(run_args_list):
+    # runs tuning_run on several devices at once. tuning_run does not take
+    # the device lock, so the caller must already hold device_lock of every
+    # serialno, and each run must target a distinct device as runs on the
+    # same device would share phone_data_dir
+    serialnos = [run_args["serialno"] for run_args in run_args_list]
+    if len(set(serialnos)) != len(serialnos):
+        raise Exception("tuning_run_many needs a distinct device per run, "
+                        "got serialnos: %s" % ", ".join(serialnos))
+    return _parallel_map(lambda run_args: tuning_run(**run_args),
+                         run_args_list,
+                         max_workers=len(run_args_list))
+
+
+@memoize
+def docker_image_exists(image_name):
+    return bool(sh_command("docker")("images", "-q", image_name).strip())
+
+
+@memoize
+def docker_container_state(container_name):
+    # returns (exists, running) from a single `docker ps`
+    for line in split_stdout(sh_command("docker")(
+            "ps", "-a", "--format", "{{.Names}} {{.Status}}")):
+        name, _, status = line.partition(" ")
+        if name == container_name:
+            return True, status.startswith("Up")
+    return False, False
+
+
+def docker_cp_files(src_paths, container_name, dst_dir):
+    # stream all files as one tar archive so docker cp runs only once
+    cmd = ["docker", "cp", "-", "%s:%s" % (container_name, dst_dir)]
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=p.stdin, mode="w|",
+                          dereference=True) as tar:
+            for src_path in src_paths:
+                tar.add(src_path, arcname=os.path.basename(src_path))
+    except BaseException:
+        # do not let docker unpack a truncated archive
+        p.kill()
+        raise
+    finally:
+        p.stdin.close()
+        p.wait()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+_caffe_container = None
+
+
+@atexit.register
+def remove_caffe_container():
+    global _caffe_container
+    if _caffe_container:
+        # plain subprocess, sh's threads break during interpreter shutdown
+        with open(os.devnull, "w") as devnull:
+            subprocess.call(["docker", "rm", "-f", _caffe_container],
+                            stdout=devnull)
+        _caffe_container = None
+
+
+def start_caffe_container(image_name, container_name):
+    # the container is set up once per process and removed at exit,
+    # returns the name of the container to use.
+    # tools/ is bind mounted so the scripts never need copying, the name
+    # carries a hash of the checkout so runs from different checkouts each
+    # get a container mounting their own tools/, and the pid so removing it
+    # at exit never hits a container another run is still using
+    global _caffe_container
+    tools_dir = os.path.abspath("tools")
+    container_name = "%s_%s_%d" % (container_name,
+                                   hashlib.md5(tools_dir).hexdigest()[:8],
+                                   os.getpid())
+    if _caffe_container == container_name:
+        return container_name
+
+    if not docker_image_exists(image_name):
+        print("Build caffe docker")
+        sh_command("docker")("build", "-t", image_name,
+                             "third_party/caffe")
+        docker_image_exists.cache_clear()
+
+    container_exists, container_running = \
+        docker_container_state(container_name)
+    if container_exists and not container_running:
+        sh_command("docker")("rm", "-f", container_name)
+        docker_container_state.cache_clear()
+        container_exists = False
+    if not container_exists:
+        print("Run caffe container")
+        sh_command("docker")(
+                "run",
+                "-d",
+                "-it",
+                "-v",
+                "%s:/mace/tools:ro" % tools_dir,
+                "--name",
+                container_name,
+                image_name,
+                "/bin/bash")
+        docker_container_state.cache_clear()
+    _caffe_container = container_name
+    return container_name
+
+
 def validate_model(abi,
                    serialno,
                    model_file_path,
@@ -823,6 +1176,10 @@ def validate_model(abi,
                    input_file_name="model_input",
                    output_file_name="model_out"):
     print("* Validate with %s" % platform)
+    input_nodes_str = ",".join(input_nodes)
+    output_nodes_str = ",".join(output_nodes)
+    input_shapes_str = ":".join(input_shapes)
+    output_shapes_str = ":".join(output_shapes)
     if abi != "host":
         for output_name in output_nodes:
             formatted_name = common.formatted_file_name(
@@ -837,8 +1194,8 @@ def validate_model(abi,
         validate(platform, model_file_path, "",
                  "%s/%s" % (model_output_dir, input_file_name),
                  "%s/%s" % (model_output_dir, output_file_name), device_type,
-                 ":".join(input_shapes), ":".join(output_shapes),
-                 ",".join(input_nodes), ",".join(output_nodes))
+                 input_shapes_str, output_shapes_str,
+                 input_nodes_str, output_nodes_str)
     elif platform == "caffe":
         image_name = "mace-caffe:latest"
         container_name = "mace_caffe_validator"
@@ -853,90 +1210,65 @@ def validate_model(abi,
                      "%s/%s" % (model_output_dir, input_file_name),
                      "%s/%s" % (model_output_dir, output_file_name),
                      device_type,
-                     ":".join(input_shapes), ":".join(output_shapes),
-                     ",".join(input_nodes), ",".join(output_nodes))
+                     input_shapes_str, output_shapes_str,
+                     input_nodes_str, output_nodes_str)
         elif caffe_env == common.CaffeEnvType.DOCKER:
-            docker_image_id = sh.docker("images", "-q", image_name)
-            if not docker_image_id:
-                print("Build caffe docker")
-                sh.docker("build", "-t", image_name,
-                          "third_party/caffe")
-
-            container_id = sh.docker("ps", "-qa", "-f",
-                                     "name=%s" % container_name)
-            if container_id and not sh.docker("ps", "-qa", "--filter",
-                                              "status=running", "-f",
-                                              "name=%s" % container_name):
-                sh.docker("rm", "-f", container_name)
-                container_id = ""
-            if not container_id:
-                print("Run caffe container")
-                sh.docker(
-                        "run",
-                        "-d",
-                        "-it",
-                        "--name",
-                        container_name,
-                        image_name,
-                        "/bin/bash")
+            container_name = start_caffe_container(image_name,
+                                                   container_name)
 
+            copy_files = []
             for input_name in input_nodes:
                 formatted_input_name = common.formatted_file_name(
                         input_file_name, input_name)
-                sh.docker(
-                        "cp",
-                        "%s/%s" % (model_output_dir, formatted_input_name),
-                        "%s:/mace" % container_name)
+                copy_files.append(
+                        "%s/%s" % (model_output_dir, formatted_input_name))
 
             for output_name in output_nodes:
                 formatted_output_name = common.formatted_file_name(
                         output_file_name, output_name)
-                sh.docker(
-                        "cp",
-                        "%s/%s" % (model_output_dir, formatted_output_name),
-                        "%s:/mace" % container_name)
+                copy_files.append(
+                        "%s/%s" % (model_output_dir, formatted_output_name))
             model_file_name = os.path.basename(model_file_path)
             weight_file_name = os.path.basename(weight_file_path)
-            sh.docker("cp", "tools/common.py", "%s:/mace" % container_name)
-            sh.docker("cp", "tools/validate.py", "%s:/mace" % container_name)
-            sh.docker("cp", model_file_path, "%s:/mace" % container_name)
-            sh.docker("cp", weight_file_path, "%s:/mace" % container_name)
+            copy_files.extend([model_file_path, weight_file_path])
+            docker_cp_files(copy_files, container_name, "/mace")
 
-            sh.docker(
+            sh_command("docker")(
                 "exec",
                 container_name,
                 "python",
                 "-u",
-                "/mace/validate.py",
+                "/mace/tools/validate.py",
                 "--platform=caffe",
                 "--model_file=/mace/%s" % model_file_name,
                 "--weight_file=/mace/%s" % weight_file_name,
                 "--input_file=/mace/%s" % input_file_name,
                 "--mace_out_file=/mace/%s" % output_file_name,
                 "--device_type=%s" % device_type,
-                "--input_node=%s" % ",".join(input_nodes),
-                "--output_node=%s" % ",".join(output_nodes),
-                "--input_shape=%s" % ":".join(input_shapes),
-                "--output_shape=%s" % ":".join(output_shapes),
+                "--input_node=%s" % input_nodes_str,
+                "--output_node=%s" % output_nodes_str,
+                "--input_shape=%s" % input_shapes_str,
+                "--output_shape=%s" % output_shapes_str,
                 _fg=True)
 
     print("Validation done!\n")
 
 
 def build_host_libraries(model_build_type, abi):
-    bazel_build("@com_google_protobuf//:protobuf_lite", abi=abi)
-    bazel_build("//mace/proto:mace_cc", abi=abi)
-    bazel_build("//mace/codegen:generated_opencl", abi=abi)
-    bazel_build("//mace/codegen:generated_tuning_params", abi=abi)
-    bazel_build("//mace/codegen:generated_version", abi=abi)
-    bazel_build("//mace/utils:utils", abi=abi)
-    bazel_build("//mace/core:core", abi=abi)
-    bazel_build("//mace/kernels:kernels", abi=abi)
-    bazel_build("//mace/ops:ops", abi=abi)
+    targets = [
+        "@com_google_protobuf//:protobuf_lite",
+        "//mace/proto:mace_cc",
+        "//mace/codegen:generated_opencl",
+        "//mace/codegen:generated_tuning_params",
+        "//mace/codegen:generated_version",
+        "//mace/utils:utils",
+        "//mace/core:core",
+        "//mace/kernels:kernels",
+        "//mace/ops:ops",
+    ]
     if model_build_type == BuildType.code:
-        bazel_build(
-            "//mace/codegen:generated_models",
-            abi=abi)
+        targets.append("//mace/codegen:generated_models")
+    bazel_build(targets, abi=abi)
 
 
 def merge_libs(target_soc,
@@ -959,86 +1291,49 @@ def merge_libs(target_soc,
         sh.cp("-f", hexagon_lib_file, library_dir)
 
     # make static library
-    mri_stream = ""
     if abi == "host":
-        mri_stream += "create %s/libmace_%s.a\n" % \
-                      (model_bin_dir, project_name)
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/codegen/libgenerated_opencl.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/codegen/libgenerated_tuning_params.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/codegen/libgenerated_version.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/core/libcore.pic.lo\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/kernels/libkernels.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/utils/libutils.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/proto/libmace_cc.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/external/com_google_protobuf/libprotobuf_lite.pic.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/ops/libops.pic.lo\n")
+        output_lib = "%s/libmace_%s.a" % (model_bin_dir, project_name)
+        libs = [
+            "bazel-bin/mace/codegen/libgenerated_opencl.pic.a",
+            "bazel-bin/mace/codegen/libgenerated_tuning_params.pic.a",
+            "bazel-bin/mace/codegen/libgenerated_version.pic.a",
+            "bazel-bin/mace/core/libcore.pic.lo",
+            "bazel-bin/mace/kernels/libkernels.pic.a",
+            "bazel-bin/mace/utils/libutils.pic.a",
+            "bazel-bin/mace/proto/libmace_cc.pic.a",
+            "bazel-bin/external/com_google_protobuf/libprotobuf_lite.pic.a",
+            "bazel-bin/mace/ops/libops.pic.lo",
+        ]
         if model_build_type == BuildType.code:
-            mri_stream += (
-                "addlib "
-                "bazel-bin/mace/codegen/libgenerated_models.pic.a\n")
+            libs.append("bazel-bin/mace/codegen/libgenerated_models.pic.a")
     else:
         if not target_soc:
-            mri_stream += "create %s/libmace_%s.a\n" % \
-                          (model_bin_dir, project_name)
+            output_lib = "%s/libmace_%s.a" % (model_bin_dir, project_name)
         else:
             device_name = adb_get_device_name_by_serialno(serial_num)
-            mri_stream += "create %s/libmace_%s.%s.%s.a\n" % \
-                          (model_bin_dir, project_name,
-                           device_name, target_soc)
+            output_lib = "%s/libmace_%s.%s.%s.a" % \
+                         (model_bin_dir, project_name,
+                          device_name, target_soc)
+        libs = []
         if model_build_type == BuildType.code:
-            mri_stream += (
-                "addlib "
-                "bazel-bin/mace/codegen/libgenerated_models.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/codegen/libgenerated_opencl.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/codegen/libgenerated_tuning_params.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/codegen/libgenerated_version.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/core/libcore.lo\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/kernels/libkernels.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/utils/libutils.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/proto/libmace_cc.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/external/com_google_protobuf/libprotobuf_lite.a\n")
-        mri_stream += (
-            "addlib "
-            "bazel-bin/mace/ops/libops.lo\n")
-
-    mri_stream += "save\n"
-    mri_stream += "end\n"
-
-    cmd = sh.Command("%s/toolchains/" % os.environ["ANDROID_NDK_HOME"] +
+            libs.append("bazel-bin/mace/codegen/libgenerated_models.a")
+        libs.extend([
+            "bazel-bin/mace/codegen/libgenerated_opencl.a",
+            "bazel-bin/mace/codegen/libgenerated_tuning_params.a",
+            "bazel-bin/mace/codegen/libgenerated_version.a",
+            "bazel-bin/mace/core/libcore.lo",
+            "bazel-bin/mace/kernels/libkernels.a",
+            "bazel-bin/mace/utils/libutils.a",
+            "bazel-bin/mace/proto/libmace_cc.a",
+            "bazel-bin/external/com_google_protobuf/libprotobuf_lite.a",
+            "bazel-bin/mace/ops/libops.lo",
+        ])
+
+    mri_stream = "\n".join(["create %s" % output_lib] +
+                           ["addlib %s" % lib for lib in libs] +
+                           ["save", "end", ""])
+
+    cmd = sh_command("%s/toolchains/" % os.environ["ANDROID_NDK_HOME"] +
                      "aarch64-linux-android-4.9/prebuilt/linux-x86_64/" +
                      "bin/aarch64-linux-android-ar")
 
@@ -1052,18 +1347,22 @@ def packaging_lib(libmace_output_dir, project_name):
     tar_package_name = "libmace_%s.tar.gz" % project_name
     project_dir = "%s/%s" % (libmace_output_dir, project_name)
     tar_package_path = "%s/%s" % (project_dir, tar_package_name)
-    if os.path.exists(tar_package_path):
-        sh.rm("-rf", tar_package_path)
+    _remove_file(tar_package_path)
 
     print("Start packaging '%s' libs into %s" % (project_name,
                                                  tar_package_path))
-    sh.tar(
-        "cvzf",
-        "%s" % tar_package_path,
-        glob.glob("%s/*" % project_dir),
-        "--exclude",
-        "%s/_tmp" % project_dir,
-        _fg=True)
+    # list the members before the package file itself is created
+    package_members = glob.glob("%s/*" % project_dir)
+    tmp_dir = os.path.normpath("%s/_tmp" % project_dir).lstrip("/")
+
+    def exclude_tmp_dir(tarinfo):
+        if tarinfo.name == tmp_dir or tarinfo.name.startswith(tmp_dir + "/"):
+            return None
+        return tarinfo
+
+    with tarfile.open(tar_package_path, "w:gz", compresslevel=1) as tar:
+        for member in package_members:
+            tar.add(member, filter=exclude_tmp_dir)
     print("Packaging Done!\n")
 
 
@@ -1084,8 +1383,7 @@ def build_benchmark_model(abi,
                 hexagon_mode=hexagon_mode)
 
     benchmark_binary_file = "%s/%s" % (model_output_dir, target_name)
-    if os.path.exists(benchmark_binary_file):
-        sh.rm("-rf", benchmark_binary_file)
+    _remove_file(benchmark_binary_file)
 
     target_bin = "/".join(bazel_target_to_bin(benchmark_target))
     sh.cp("-f", target_bin, model_output_dir)
@@ -1115,6 +1413,10 @@ def benchmark_model(abi,
                     input_file_name="model_input",
                     linkshared=0):
     print("* Benchmark for %s" % model_tag)
+    input_nodes_str = ",".join(input_nodes)
+    output_nodes_str = ",".join(output_nodes)
+    input_shapes_str = ":".join(input_shapes)
+    output_shapes_str = ":".join(output_shapes)
 
     if linkshared == 0:
         benchmark_model_target = "benchmark_model_static"
@@ -1131,10 +1433,10 @@ def benchmark_model(abi,
                 "MACE_CPP_MIN_VLOG_LEVEL=%s" % vlog_level,
                 "%s/%s" % (benchmark_binary_dir, benchmark_model_target),
                 "--model_name=%s" % model_tag,
-                "--input_node=%s" % ",".join(input_nodes),
-                "--output_node=%s" % ",".join(output_nodes),
-                "--input_shape=%s" % ":".join(input_shapes),
-                "--output_shape=%s" % ":".join(output_shapes),
+                "--input_node=%s" % input_nodes_str,
+                "--output_node=%s" % output_nodes_str,
+                "--input_shape=%s" % input_shapes_str,
+                "--output_shape=%s" % output_shapes_str,
                 "--input_file=%s/%s" % (model_output_dir, input_file_name),
                 "--model_data_file=%s/%s.data" % (mace_model_dir, model_tag),
                 "--device=%s" % device_type,
@@ -1146,37 +1448,30 @@ def benchmark_model(abi,
             ])
         p.wait()
     else:
-        sh.adb("-s", serialno, "shell", "mkdir", "-p", phone_data_dir)
+        # creating the internal storage dir creates phone_data_dir as well
         internal_storage_dir = create_internal_storage_dir(
             serialno, phone_data_dir)
 
+        push_files = []
         for input_name in input_nodes:
             formatted_name = common.formatted_file_name(input_file_name,
                                                         input_name)
-            adb_push("%s/%s" % (model_output_dir, formatted_name),
-                     phone_data_dir, serialno)
+            push_files.append("%s/%s" % (model_output_dir, formatted_name))
         if not embed_model_data:
-            adb_push("%s/%s.data" % (mace_model_dir, model_tag),
-                     phone_data_dir, serialno)
+            push_files.append("%s/%s.data" % (mace_model_dir, model_tag))
         if device_type == common.DeviceType.GPU \
                 and os.path.exists(opencl_binary_file):
-            adb_push(opencl_binary_file, phone_data_dir, serialno)
+            push_files.append(opencl_binary_file)
         mace_model_phone_path = ""
         if build_type == BuildType.proto:
             mace_model_phone_path = "%s/%s.pb" % (phone_data_dir, model_tag)
-            adb_push(mace_model_path,
-                     mace_model_phone_path,
-                     serialno)
+            push_files.append(mace_model_path)
 
         if linkshared == 1:
-            adb_push("%s/libmace.so" % shared_library_dir, phone_data_dir,
-                     serialno)
-            adb_push("%s/libgnustl_shared.so" % shared_library_dir,
-                     phone_data_dir,
-                     serialno)
-        adb_push("%s/%s" % (benchmark_binary_dir, benchmark_model_target),
-                 phone_data_dir,
-                 serialno)
+            push_files.append("%s/libmace.so" % shared_library_dir)
+            push_files.append("%s/libgnustl_shared.so" % shared_library_dir)
+        push_files.append("%s/%s" % (benchmark_binary_dir,
+                                     benchmark_model_target))
 
         adb_cmd = [
             "LD_LIBRARY_PATH=%s" % phone_data_dir,
@@ -1187,10 +1482,10 @@ def benchmark_model(abi,
             "MACE_OPENCL_PROFILING=1",
             "%s/%s" % (phone_data_dir, benchmark_model_target),
             "--model_name=%s" % model_tag,
-            "--input_node=%s" % ",".join(input_nodes),
-            "--output_node=%s" % ",".join(output_nodes),
-            "--input_shape=%s" % ":".join(input_shapes),
-            "--output_shape=%s" % ":".join(output_shapes),
+            "--input_node=%s" % input_nodes_str,
+            "--output_node=%s" % output_nodes_str,
+            "--input_shape=%s" % input_shapes_str,
+            "--output_shape=%s" % output_shapes_str,
             "--input_file=%s/%s" % (phone_data_dir, input_file_name),
             "--model_data_file=%s/%s.data" % (phone_data_dir, model_tag),
             "--device=%s" % device_type,
@@ -1205,27 +1500,12 @@ def benchmark_model(abi,
         adb_cmd = ' '.join(adb_cmd)
         cmd_file_name = "%s-%s-%s" % ('cmd_file', model_tag, str(time.time()))
         adb_cmd_file = "%s/%s" % (phone_data_dir, cmd_file_name)
-        tmp_cmd_file = "%s/%s" % ('/tmp', cmd_file_name)
-        with open(tmp_cmd_file, 'w') as cmd_file:
-            cmd_file.write(adb_cmd)
-        adb_push(tmp_cmd_file, adb_cmd_file, serialno)
-        os.remove(tmp_cmd_file)
+        adb_push_files(push_files, phone_data_dir, serialno,
+                       staging_root=model_output_dir,
+                       file_contents={cmd_file_name: adb_cmd})
 
-        sh.adb(
-            "-s",
-            serialno,
-            "shell",
-            "sh",
-            adb_cmd_file,
-            _fg=True)
-
-        sh.adb(
-            "-s",
-            serialno,
-            "shell",
-            "rm",
-            adb_cmd_file,
-            _fg=True)
+        adb_shell(serialno, "sh", adb_cmd_file)
+        adb_shell(serialno, "rm", adb_cmd_file)
 
     print("Benchmark done!\n")
 
@@ -1248,6 +1528,10 @@ def build_run_throughput_test(abi,
                               strip="always",
                               input_file_name="model_input"):
     print("* Build and run throughput_test")
+    input_nodes_str = ",".join(input_nodes)
+    output_nodes_str = ",".join(output_nodes)
+    input_shapes_str = ":".join(input_shapes)
+    output_shapes_str = ":".join(output_shapes)
 
     model_tag_build_flag = ""
     if cpu_model_tag:
@@ -1261,7 +1545,7 @@ def build_run_throughput_test(abi,
                                 dsp_model_tag
 
     sh.cp("-f", merged_lib_file, "mace/benchmark/libmace_merged.a")
-    sh.bazel(
+    sh_command("bazel")(
         "build",
         "-c",
         "opt",
@@ -1284,46 +1568,29 @@ def build_run_throughput_test(abi,
         _fg=True)
 
     sh.rm("mace/benchmark/libmace_merged.a")
-    sh.adb("-s",
-           serialno,
-           "shell",
-           "mkdir",
-           "-p",
-           phone_data_dir)
-    adb_push("%s/%s_%s" % (model_input_dir, input_file_name,
-                           ",".join(input_nodes)),
-             phone_data_dir,
-             serialno)
-    adb_push("bazel-bin/mace/benchmark/model_throughput_test",
-             phone_data_dir,
-             serialno)
+    push_files = [
+        "%s/%s_%s" % (model_input_dir, input_file_name, input_nodes_str),
+        "bazel-bin/mace/benchmark/model_throughput_test",
+    ]
     if not embed_model_data:
-        adb_push("codegen/models/%s/%s.data" % cpu_model_tag,
-                 phone_data_dir,
-                 serialno)
-        adb_push("codegen/models/%s/%s.data" % gpu_model_tag,
-                 phone_data_dir,
-                 serialno)
-        adb_push("codegen/models/%s/%s.data" % dsp_model_tag,
-                 phone_data_dir,
-                 serialno)
-    adb_push("third_party/nnlib/libhexagon_controller.so",
-             phone_data_dir,
-             serialno)
-
-    sh.adb(
-        "-s",
+        push_files.append("codegen/models/%s/%s.data" % cpu_model_tag)
+        push_files.append("codegen/models/%s/%s.data" % gpu_model_tag)
+        push_files.append("codegen/models/%s/%s.data" % dsp_model_tag)
+    push_files.append("third_party/nnlib/libhexagon_controller.so")
+    adb_push_files(push_files, phone_data_dir, serialno,
+                   staging_root=model_input_dir)
+
+    adb_shell(
         serialno,
-        "shell",
         "LD_LIBRARY_PATH=%s" % phone_data_dir,
         "MACE_CPP_MIN_VLOG_LEVEL=%s" % vlog_level,
         "MACE_RUN_PARAMETER_PATH=%s/mace_run.config" %
         phone_data_dir,
         "%s/model_throughput_test" % phone_data_dir,
-        "--input_node=%s" % ",".join(input_nodes),
-        "--output_node=%s" % ",".join(output_nodes),
-        "--input_shape=%s" % ":".join(input_shapes),
-        "--output_shape=%s" % ":".join(output_shapes),
+        "--input_node=%s" % input_nodes_str,
+        "--output_node=%s" % output_nodes_str,
+        "--input_shape=%s" % input_shapes_str,
+        "--output_shape=%s" % output_shapes_str,
         "--input_file=%s/%s" % (phone_data_dir, input_file_name),
         "--cpu_model_data_file=%s/%s.data" % (phone_data_dir,
                                               cpu_model_tag),
@@ -1331,8 +1598,7 @@ def build_run_throughput_test(abi,
                                               gpu_model_tag),
         "--dsp_model_data_file=%s/%s.data" % (phone_data_dir,
                                               dsp_model_tag),
-        "--run_seconds=%s" % run_seconds,
-        _fg=True)
+        "--run_seconds=%s" % run_seconds)
 
     print("throughput_test done!\n")
 
@@ -1341,22 +1607,17 @@ def build_run_throughput_test(abi,
 # falcon
 ################################
 def falcon_tags(tags_dict):
-    tags = ""
-    for k, v in tags_dict.iteritems():
-        if tags == "":
-            tags = "%s=%s" % (k, v)
-        else:
-            tags = tags + ",%s=%s" % (k, v)
-    return tags
+    return ",".join("%s=%s" % (k, v) for k, v in tags_dict.iteritems())
 
 
 def falcon_push_metrics(server, metrics, endpoint="mace_dev", tags={}):
     cli = falcon_cli.FalconCli.connect(server=server, port=8433, debug=False)
     ts = int(time.time())
+    tags_str = falcon_tags(tags)
     falcon_metrics = [{
         "endpoint": endpoint,
         "metric": key,
-        "tags": falcon_tags(tags),
+        "tags": tags_str,
         "timestamp": ts,
         "value": value,
         "step": 600,